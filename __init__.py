@@ -14,155 +14,33 @@
 import bpy
 from bpy.types import Operator
 from bpy.props import BoolProperty
-import mathutils
 
-from .constants import Widget
+from .functions import set_mode
+from .rig_functions import RigResult, build_lattice_rig, check_rig_options, find_rigs, remove_rig
+from .selection_functions import clear_control_indices, clear_control_indices_handler, find_controls_in_radius, find_controls_in_range, find_nearest_control, get_control_indices, get_selected_vertex_coordinates, prune_control_indices_handler, refresh_control_indices, select_bones
+from .constants import RIG_PROPERTY
 
-from .functions import find_objects_that_reference_lattice, setup_bone_collections, setup_widgets
-from .armature_functions import align_bone_roll, assign_bone_shape_to_list, assign_bones_to_collection, assign_transform_constraint, assign_copy_scale_constraint, create_bone, duplicate_bone, get_bone_tail
-
-
-def main(context, align_with_lattice, root_to_bottom, bone_name, def_prefix, def_collection_name, lattice_collection_name):
-    bone_length = 0.3
-    lat_point_count = 0
 
+def main(context, align_with_lattice, root_to_bottom, bone_name, def_prefix, def_collection_name, lattice_collection_name, group_axes=("W",)):
     lattice = [obj for obj in bpy.context.selected_objects if obj.type == "LATTICE"][0]
-    lattice_name = lattice.name
-    
     armature = [obj for obj in bpy.context.selected_objects if obj.type == "ARMATURE"][0]
-    armature_name = armature.name
-    
-    lat_point_count = len(lattice.data.points)
-    lat_vertical_res = lattice.data.points_w
-    lat_group_count = int(lat_point_count/lat_vertical_res)
-    lattice_matrix_world = lattice.matrix_world
-
-    # Set armature to active object and go to edit mode
-    bpy.context.view_layer.objects.active = armature
-    bpy.ops.object.mode_set(mode='EDIT')
-
-    # Create root bone at lattice origin
-    def_bone_name = f"{def_prefix}-{bone_name}_root"
-    lattice_world_location = lattice_matrix_world.translation
-    root_offset = lattice.scale.z / 2
-    bone_head = lattice_world_location
-    if root_to_bottom:
-        bone_head = lattice_world_location + (lattice_matrix_world.to_3x3() @ mathutils.Vector((0, 0, -1))).normalized() * root_offset
-    local_tail_offset = mathutils.Vector((0, bone_length * 3, 0))
-
-    bone_tail = get_bone_tail(align_with_lattice, lattice_matrix_world, bone_head, local_tail_offset)
-
-    root_bone = create_bone(armature, def_bone_name, bone_head, bone_tail)
-    align_bone_roll(align_with_lattice, lattice_matrix_world, root_bone)
-    root_bone.use_deform = False
-    root_bone_name = root_bone.name
-
-    # Create bones at each vertex of the lattice
-    def_bones = []
-    master_bones = []
-    control_bones = []
-
-    for group_index in range(0, lat_point_count, lat_group_count):
-        print(f"Main loop iteration starting at group_index {group_index}")
-        global_index = group_index
-        group_center = mathutils.Vector((0, 0, 0))
-        group_parent_bone = None
-
-        # Calculate group center
-        for local_index in range(group_index, min(group_index + lat_group_count, lat_point_count)):
-            local_point = lattice.data.points[local_index]
-            group_center += lattice_matrix_world @ local_point.co
-        group_center = group_center / lat_group_count
-        
-        def_bone_name = f"parent_{bone_name}_{group_index}"
-        bone_head = group_center
-        bone_tail_offset = mathutils.Vector((0, bone_length * 2, 0))
-        bone_tail = get_bone_tail(align_with_lattice, lattice_matrix_world, bone_head, bone_tail_offset)
-
-        group_parent_bone = create_bone(armature, def_bone_name, bone_head, bone_tail)
-        align_bone_roll(align_with_lattice, lattice_matrix_world, group_parent_bone)
-        master_bones.append(group_parent_bone.name)
-        group_parent_bone.use_deform = False
-        group_parent_bone.parent = root_bone
-        
-        for local_index in range(group_index, min(group_index + lat_group_count, lat_point_count)):
-            point = lattice.data.points[local_index]
-
-            # Create deform bone
-            def_bone_name = f"DEF-{bone_name}_{global_index}"
-            bone_head = lattice.matrix_world @ point.co
-            bone_tail_offset = mathutils.Vector((0, bone_length, 0))
-            bone_tail = get_bone_tail(align_with_lattice, lattice_matrix_world, bone_head, bone_tail_offset)
-
-            # Create a deform bone in edit mode
-            def_bone = create_bone(armature, def_bone_name, bone_head, bone_tail)
-            align_bone_roll(align_with_lattice, lattice_matrix_world, def_bone)
-            def_bone.parent = root_bone
-            def_bones.append(def_bone_name)
-
-            # create control bone for deformation bone and setup constraints
-            control_bone_name = f"{bone_name}_{global_index}"
-            control_bone = duplicate_bone(armature, def_bone_name, control_bone_name, keep_parent=False)
-            control_bone.parent = group_parent_bone
-            control_bones.append(control_bone_name)
-
-            global_index += 1
-
-    # Assign constraints    
-    bpy.ops.object.mode_set(mode='POSE')
-    for index, def_bone in enumerate(def_bones):
-        assign_transform_constraint(armature, def_bone, control_bones[index])
-        assign_copy_scale_constraint(armature, control_bones[index], root_bone_name)
-    
-    # Create widget collection and widget shapes
-    setup_widgets()
-
-    # assign bone shapes
-    square_custom_scale = mathutils.Vector((lattice.scale.x, lattice.scale.y, 1))
-    align_with_object_name = lattice_name if not align_with_lattice else None
-    assign_bone_shape_to_list(armature, Widget.SPHERE, control_bones)
-    assign_bone_shape_to_list(armature, Widget.SQUARE, master_bones, 
-                              custom_scale=square_custom_scale,
-                              align_with_object_name=align_with_object_name)
-    assign_bone_shape_to_list(armature, Widget.CUBE, [root_bone_name,])
-
-    # assign bones to collections
-    setup_bone_collections(armature, [def_collection_name, lattice_collection_name,], collections_to_hide=[def_collection_name,])
-    assign_bones_to_collection(armature, def_bones, def_collection_name)
-    assign_bones_to_collection(armature, control_bones + master_bones + [root_bone_name,], lattice_collection_name)
-
-    armature.update_tag()
-    depsgraph = bpy.context.evaluated_depsgraph_get()
-    depsgraph.update()
-
-    bpy.context.view_layer.objects.active = lattice
-    bpy.ops.object.mode_set(mode='OBJECT')
-
-    # Add vertex groups and assign weights for each bone
-    for vertex_index, def_bone_name in enumerate(def_bones):
-        print(f"vertex_index: '{vertex_index}', bone_name: '{def_bone_name}'.")
-        vertex_group = lattice.vertex_groups.new(name=def_bone_name)
-        vertex_group.add([vertex_index], 1.0, 'REPLACE')
-
-    # Add armature modifier to the lattice
-    modifier = lattice.modifiers.new(name="Armature", type='ARMATURE')
-    modifier.object = armature
-
-    # Parent lattice and meshes referencing the lattice to the armature
-    lattice.parent = armature
-    referenced_mesh_objects = find_objects_that_reference_lattice(lattice_name)
-    for mesh_object_name in referenced_mesh_objects:
-        mesh_object = bpy.data.objects.get(mesh_object_name)
-        mesh_object.parent = armature
+
+    result = build_lattice_rig(lattice, armature,
+                               align_with_lattice=align_with_lattice,
+                               root_to_bottom=root_to_bottom,
+                               bone_name=bone_name,
+                               def_prefix=def_prefix,
+                               def_collection_name=def_collection_name,
+                               lattice_collection_name=lattice_collection_name,
+                               group_axes=group_axes)
 
     # Restore starting conditions so the redo panel works
     bpy.ops.object.select_all(action='DESELECT')
-    bpy.data.objects[armature_name].select_set(True)
-    bpy.data.objects[lattice_name].select_set(True)
-    bpy.context.view_layer.objects.active = bpy.data.objects[armature_name]
-    bpy.ops.object.mode_set(mode='OBJECT')
+    armature.select_set(True)
+    lattice.select_set(True)
+    set_mode(armature, 'OBJECT')
 
-    print("Bones have been created and weighted to the lattice vertices.")
+    print(f"{len(result.def_bones)} bones have been created and weighted to the lattice vertices in {result.timings['total']:.3f}s.")
 
 
 class ARMATURE_OT_rig_lattice(Operator):
@@ -182,6 +60,28 @@ class ARMATURE_OT_rig_lattice(Operator):
         default=False
     )
 
+    group_axis: bpy.props.EnumProperty(
+        name="Group Axis",
+        description="Lattice axis along which the points are grouped under master bones",
+        items=[
+            ('U', "U", "One master bone per U slice"),
+            ('V', "V", "One master bone per V slice"),
+            ('W', "W", "One master bone per W layer"),
+        ],
+        default='W'
+    )
+    nested_group_axis: bpy.props.EnumProperty(
+        name="Nested Group Axis",
+        description="Lattice axis for a second level of master bones within each group",
+        items=[
+            ('NONE', "None", "No nested master bones"),
+            ('U', "U", "One nested master bone per U slice of each group"),
+            ('V', "V", "One nested master bone per V slice of each group"),
+            ('W', "W", "One nested master bone per W layer of each group"),
+        ],
+        default='NONE'
+    )
+
     bone_name: bpy.props.StringProperty(
         name="Bone Name",
         description="The name of the bones to be created",
@@ -217,6 +117,8 @@ class ARMATURE_OT_rig_lattice(Operator):
 
             layout.prop(self, "align_with_lattice")
             layout.prop(self, "root_to_bottom")
+            layout.prop(self, "group_axis")
+            layout.prop(self, "nested_group_axis")
 
             layout.separator()
             layout.prop(self, "bone_name")
@@ -242,28 +144,237 @@ class ARMATURE_OT_rig_lattice(Operator):
         return True
 
     def execute(self, context):
+        group_axes = (self.group_axis,)
+        if self.nested_group_axis not in {'NONE', self.group_axis}:
+            group_axes += (self.nested_group_axis,)
+
+        # Only the checks that run before anything is built may cancel, later errors must keep their undo step
+        lattice = [obj for obj in bpy.context.selected_objects if obj.type == "LATTICE"][0]
+        try:
+            check_rig_options(lattice, group_axes)
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+
         main(context, 
              self.align_with_lattice,
              self.root_to_bottom,
              self.bone_name,
              self.def_bones_prefix,
              self.def_collection_name,
-             self.lattice_collection_name
+             self.lattice_collection_name,
+             group_axes
              )
         return {'FINISHED'}
 
+class ARMATURE_OT_unrig_lattice(Operator):
+    """Remove the rigs created by Rig Lattice from the selected lattices and armatures"""
+    bl_idname = "armature.unrig_lattice"
+    bl_label = "Unrig lattice"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return len(find_rigs(bpy.context.selected_objects)) > 0
+
+    def execute(self, context):
+        active_object = bpy.context.view_layer.objects.active
+        rigs = find_rigs(bpy.context.selected_objects)
+
+        for armature, rig_id in rigs:
+            remove_rig(armature, rig_id)
+
+        if active_object:
+            set_mode(active_object, 'OBJECT')
+
+        self.report({'INFO'}, f"Removed {len(rigs)} lattice rig(s)")
+        return {'FINISHED'}
+
+
+def rigged_armature_poll(context):
+    armature = bpy.context.active_object
+    return bpy.context.mode == 'POSE' and armature and armature.type == 'ARMATURE' and RIG_PROPERTY in armature
+
+
+class POSE_OT_rig_lattice_select_radius(Operator):
+    """Select the lattice controls within a radius of the 3D cursor"""
+    bl_idname = "pose.rig_lattice_select_radius"
+    bl_label = "Select Lattice Controls Around Cursor"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    radius: bpy.props.FloatProperty(
+        name="Radius",
+        description="Distance from the 3D cursor within which controls are selected",
+        default=0.5,
+        min=0.0,
+        subtype='DISTANCE'
+    )
+    extend: bpy.props.BoolProperty(
+        name="Extend",
+        description="Add to the current selection",
+        default=False
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return rigged_armature_poll(context)
+
+    def execute(self, context):
+        armature = bpy.context.active_object
+        center = bpy.context.scene.cursor.location
+        bone_names = []
+        for control_index in get_control_indices(armature):
+            bone_names += find_controls_in_radius(control_index, center, self.radius)
+        select_bones(armature, bone_names, extend=self.extend)
+        return {'FINISHED'}
+
+
+class POSE_OT_rig_lattice_select_range(Operator):
+    """Select the lattice controls inside a range of lattice u, v and w indices"""
+    bl_idname = "pose.rig_lattice_select_range"
+    bl_label = "Select Lattice Controls In Range"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    u_range: bpy.props.IntVectorProperty(
+        name="U Range",
+        description="First and last u index to select",
+        size=2,
+        min=0,
+        default=(0, 0)
+    )
+    v_range: bpy.props.IntVectorProperty(
+        name="V Range",
+        description="First and last v index to select",
+        size=2,
+        min=0,
+        default=(0, 0)
+    )
+    w_range: bpy.props.IntVectorProperty(
+        name="W Range",
+        description="First and last w index to select",
+        size=2,
+        min=0,
+        default=(0, 0)
+    )
+    extend: bpy.props.BoolProperty(
+        name="Extend",
+        description="Add to the current selection",
+        default=False
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return rigged_armature_poll(context)
+
+    def execute(self, context):
+        armature = bpy.context.active_object
+        bone_names = []
+        try:
+            for control_index in get_control_indices(armature):
+                bone_names += find_controls_in_range(control_index, self.u_range, self.v_range, self.w_range)
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        select_bones(armature, bone_names, extend=self.extend)
+        return {'FINISHED'}
+
+
+class POSE_OT_rig_lattice_select_nearest(Operator):
+    """Select the lattice control nearest to each selected vertex of the selected meshes"""
+    bl_idname = "pose.rig_lattice_select_nearest"
+    bl_label = "Select Lattice Controls Nearest To Vertices"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    extend: bpy.props.BoolProperty(
+        name="Extend",
+        description="Add to the current selection",
+        default=False
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return rigged_armature_poll(context)
+
+    def execute(self, context):
+        armature = bpy.context.active_object
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        control_indices = get_control_indices(armature)
+
+        bone_names = []
+        for obj in [obj for obj in bpy.context.selected_objects if obj.type == 'MESH']:
+            for co in get_selected_vertex_coordinates(obj, depsgraph):
+                # Each vertex picks the closest control over all rigs on the armature
+                nearest = [find_nearest_control(control_index, co) for control_index in control_indices]
+                nearest = [(distance, bone_name) for bone_name, distance in nearest if bone_name]
+                if nearest:
+                    bone_names.append(min(nearest)[1])
+
+        if not bone_names:
+            self.report({'WARNING'}, "No selected mesh vertices found")
+            return {'CANCELLED'}
+
+        select_bones(armature, bone_names, extend=self.extend)
+        return {'FINISHED'}
+
+
+class POSE_OT_rig_lattice_refresh_index(Operator):
+    """Rebuild the lattice control index from the current pose"""
+    bl_idname = "pose.rig_lattice_refresh_index"
+    bl_label = "Refresh Lattice Control Index"
+
+    @classmethod
+    def poll(cls, context):
+        return rigged_armature_poll(context)
+
+    def execute(self, context):
+        refresh_control_indices(bpy.context.active_object)
+        return {'FINISHED'}
+
+
+def rig_lattice_select_menu(self, context):
+    layout = self.layout
+    layout.separator()
+    layout.operator(POSE_OT_rig_lattice_select_radius.bl_idname, text="Lattice Controls Around Cursor")
+    layout.operator(POSE_OT_rig_lattice_select_range.bl_idname, text="Lattice Controls In Range")
+    layout.operator(POSE_OT_rig_lattice_select_nearest.bl_idname, text="Lattice Controls Nearest To Vertices")
+    layout.operator(POSE_OT_rig_lattice_refresh_index.bl_idname, text="Refresh Lattice Control Index")
+
+
 def rig_lattice_button(self, context):
     self.layout.operator(
         ARMATURE_OT_rig_lattice.bl_idname,
         text="Rig Lattice")
+    self.layout.operator(
+        ARMATURE_OT_unrig_lattice.bl_idname,
+        text="Unrig Lattice")
+
+classes = (
+    ARMATURE_OT_rig_lattice,
+    ARMATURE_OT_unrig_lattice,
+    POSE_OT_rig_lattice_select_radius,
+    POSE_OT_rig_lattice_select_range,
+    POSE_OT_rig_lattice_select_nearest,
+    POSE_OT_rig_lattice_refresh_index,
+)
 
 def register():
-    bpy.utils.register_class(ARMATURE_OT_rig_lattice)
+    for cls in classes:
+        bpy.utils.register_class(cls)
     bpy.types.VIEW3D_MT_object.append(rig_lattice_button)
+    bpy.types.VIEW3D_MT_select_pose.append(rig_lattice_select_menu)
+    bpy.app.handlers.undo_post.append(prune_control_indices_handler)
+    bpy.app.handlers.redo_post.append(prune_control_indices_handler)
+    bpy.app.handlers.load_post.append(clear_control_indices_handler)
 
 def unregister():
-    bpy.utils.unregister_class(ARMATURE_OT_rig_lattice)
+    for cls in reversed(classes):
+        bpy.utils.unregister_class(cls)
     bpy.types.VIEW3D_MT_object.remove(rig_lattice_button)
+    bpy.types.VIEW3D_MT_select_pose.remove(rig_lattice_select_menu)
+    bpy.app.handlers.undo_post.remove(prune_control_indices_handler)
+    bpy.app.handlers.redo_post.remove(prune_control_indices_handler)
+    bpy.app.handlers.load_post.remove(clear_control_indices_handler)
+    clear_control_indices()
 
 if __name__ == "__main__":
     try:
@@ -1,13 +1,14 @@
 import bpy
 import mathutils
 
+from .functions import set_mode
+
 def assign_bone_shape(armature, bone_name, widget_name):
     custom_shape = bpy.data.objects.get(widget_name)
 
     if armature and custom_shape and armature.type == 'ARMATURE':
         # Switch to pose mode to assign the custom shape
-        bpy.context.view_layer.objects.active = armature
-        bpy.ops.object.mode_set(mode='POSE')
+        set_mode(armature, 'POSE')
         
         # Get the pose bone
         pose_bone = armature.pose.bones.get(bone_name)
@@ -27,18 +28,18 @@ def assign_bone_shape(armature, bone_name, widget_name):
             print(f"Bone '{bone_name}' not found in armature '{armature.name}'.")
         
         # Return to edit mode
-        bpy.ops.object.mode_set(mode='EDIT')
+        set_mode(armature, 'EDIT')
     else:
         print("Ensure that the armature and custom shape object exist and are correctly named.")
 
 
-def assign_bone_shape_to_list(armature, widget_name, bone_names, custom_scale=None, align_with_object_name=None):
+def assign_bone_shape_to_list(armature, widget_name, bone_names, custom_scale=None, custom_rotation=None, align_with_object_name=None):
     custom_shape = bpy.data.objects.get(widget_name)
+    bone_names = set(bone_names)
 
     if armature and custom_shape and armature.type == 'ARMATURE':
         # Switch to pose mode to assign the custom shape
-        bpy.context.view_layer.objects.active = armature
-        bpy.ops.object.mode_set(mode='POSE')
+        set_mode(armature, 'POSE')
         
         # Get the pose bone
         for pose_bone in [bone for bone in armature.pose.bones if bone.name in bone_names]:
@@ -47,8 +48,14 @@ def assign_bone_shape_to_list(armature, widget_name, bone_names, custom_scale=No
             if custom_scale:
                 pose_bone.custom_shape_scale_xyz = custom_scale
             
+            rotation = custom_rotation
             if align_with_object_name:
-                pose_bone.custom_shape_rotation_euler = align_bone_shape_to_object(armature, pose_bone.name, align_with_object_name)
+                # Custom rotation is relative to the object the shape gets aligned with
+                rotation = align_bone_shape_to_object(armature, pose_bone.name, align_with_object_name)
+                if rotation and custom_rotation:
+                    rotation = (rotation.to_matrix() @ custom_rotation.to_matrix()).to_euler()
+            if rotation:
+                pose_bone.custom_shape_rotation_euler = rotation
 
             # Prevent scaling by bone size
             pose_bone.use_custom_shape_bone_size = False  
@@ -56,16 +63,12 @@ def assign_bone_shape_to_list(armature, widget_name, bone_names, custom_scale=No
             print(f"Custom shape '{widget_name}' assigned.")
         else:
             print(f"Widget '{widget_name}' not found.")
-        
-        # Return to edit mode
-        bpy.ops.object.mode_set(mode='EDIT')
     else:
         print("Ensure that the armature and custom shape object exist and are correctly named.")
 
 
 def create_bone(armature, bone_name, head, tail):
-    bpy.context.view_layer.objects.active = armature
-    bpy.ops.object.mode_set(mode='EDIT')
+    set_mode(armature, 'EDIT')
     
     bone = armature.data.edit_bones.new(bone_name)
     bone.head = head
@@ -74,16 +77,14 @@ def create_bone(armature, bone_name, head, tail):
 
 
 def assign_bone_to_collection(armature, bone_name, collection_name):
-    bpy.context.view_layer.objects.active = armature
-    bpy.ops.object.mode_set(mode='POSE')
+    set_mode(armature, 'POSE')
 
     pose_bone = armature.pose.bones[bone_name]
     armature.data.collections[collection_name].assign(pose_bone)
 
 
 def assign_bones_to_collection(armature, bone_names, collection_name):
-    bpy.context.view_layer.objects.active = armature
-    bpy.ops.object.mode_set(mode='POSE')
+    set_mode(armature, 'POSE')
     
     for bone_name in bone_names:
         pose_bone = armature.pose.bones[bone_name]
@@ -139,8 +140,7 @@ def align_bone_shape_to_object(armature_obj, bone_name, target_obj_name):
         return
 
     # Enter pose mode
-    bpy.context.view_layer.objects.active = armature_obj
-    bpy.ops.object.mode_set(mode='POSE')
+    set_mode(armature_obj, 'POSE')
 
     # Get the pose bone
     pose_bone = armature_obj.pose.bones.get(bone_name)
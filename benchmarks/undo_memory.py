@@ -0,0 +1,131 @@
+# Measure the undo footprint of building a lattice rig.
+#
+# With the UI, so the undo stack can be inspected:
+#   blender --factory-startup --python benchmarks/undo_memory.py -- --resolution 12 --redos 3
+# Headless, only the memory of the rig itself (undo operators need a screen):
+#   blender --background --factory-startup --python benchmarks/undo_memory.py -- --resolution 12
+
+import argparse
+import importlib.util
+import os
+import resource
+import sys
+from pathlib import Path
+
+import bpy
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description="Measure the undo footprint of Rig Lattice")
+    parser.add_argument("--resolution", type=int, default=12, help="Lattice points along u, v and w")
+    parser.add_argument("--redos", type=int, default=3, help="Redo panel re-executions after the first build")
+    return parser.parse_args(argv)
+
+
+def load_addon():
+    # Load the add-on straight from the repository, no installation needed
+    addon_root = Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location("rig_lattice", addon_root / "__init__.py",
+                                                  submodule_search_locations=[str(addon_root)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["rig_lattice"] = module
+    spec.loader.exec_module(module)
+    module.register()
+    return module
+
+
+def get_rss_mb():
+    # Current resident set size where /proc is available, peak resident set size otherwise
+    try:
+        with open(f"/proc/{os.getpid()}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def setup_scene(resolution):
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj)
+
+    lattice_data = bpy.data.lattices.new("bench_lattice")
+    lattice_data.points_u = lattice_data.points_v = lattice_data.points_w = resolution
+    lattice = bpy.data.objects.new("bench_lattice", lattice_data)
+    lattice.scale = (4, 4, 4)
+
+    armature = bpy.data.objects.new("bench_armature", bpy.data.armatures.new("bench_armature"))
+
+    for obj in (lattice, armature):
+        bpy.context.scene.collection.objects.link(obj)
+        obj.select_set(True)
+    bpy.context.view_layer.objects.active = armature
+
+
+def count_undo_steps():
+    # Undo back to the start of the stack, the scene is not used afterwards
+    steps = 0
+    while bpy.ops.ed.undo.poll():
+        bpy.ops.ed.undo()
+        steps += 1
+    return steps
+
+
+def run(args, context_override):
+    with bpy.context.temp_override(**context_override):
+        setup_scene(args.resolution)
+        has_undo = not bpy.app.background
+        if has_undo:
+            bpy.ops.ed.undo_push(message="Benchmark start")
+
+        # Build without an undo push first, so the memory of the rig itself is measured on its own
+        rss_before = get_rss_mb()
+        bpy.ops.armature.rig_lattice('EXEC_DEFAULT', False)
+        rss_build = get_rss_mb()
+
+        bone_count = len(bpy.data.objects["bench_armature"].data.bones)
+        print(f"Lattice resolution:        {args.resolution} ({args.resolution ** 3} points, {bone_count} bones)")
+        print(f"RSS before build:          {rss_before:.1f} MB")
+        print(f"Rig (build, no undo push): +{rss_build - rss_before:.1f} MB")
+
+        if not has_undo:
+            print("Undo memory:               not measurable without the UI, undo operators need a screen")
+            return
+
+        # The step the operator would have pushed after the build
+        bpy.ops.ed.undo_push(message="Rig lattice")
+        rss_push = get_rss_mb()
+        print(f"Undo step of the build:    +{rss_push - rss_build:.1f} MB")
+
+        for _redo in range(args.redos):
+            # The redo panel undoes the last step and executes the operator again
+            bpy.ops.ed.undo()
+            bpy.ops.armature.rig_lattice('EXEC_DEFAULT', True)
+        rss_redo = get_rss_mb()
+        # The rig is the same size after every redo, so any growth is held by the undo stack
+        print(f"Undo growth over {args.redos} redo(s): +{rss_redo - rss_push:.1f} MB")
+
+        # One step for the benchmark start plus one per build that is still on the stack
+        undo_steps = count_undo_steps()
+        print(f"Undo steps since start:    {undo_steps - 1} (expected 1)")
+
+
+def main():
+    args = parse_args()
+    load_addon()
+
+    if bpy.app.background:
+        run(args, {})
+        return
+
+    def run_in_window():
+        window = bpy.context.window_manager.windows[0]
+        area = next(area for area in window.screen.areas if area.type == 'VIEW_3D')
+        run(args, {"window": window, "screen": window.screen, "area": area})
+        bpy.ops.wm.quit_blender()
+
+    # Wait for the window to be ready before touching the undo stack
+    bpy.app.timers.register(run_in_window, first_interval=1.0)
+
+
+main()
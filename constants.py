@@ -5,3 +5,11 @@ class Widget(StrEnum):
     CIRCLE = "LAT_WGT_circle"
     SQUARE = "LAT_WGT_square"
     CUBE = "LAT_WGT_cube"
+
+
+# Custom property holding the rig metadata on the armature and on the lattice
+RIG_PROPERTY = "rig_lattice"
+
+
+# Index of each lattice axis in the (w, v, u) point grid
+GRID_AXES = {"W": 0, "V": 1, "U": 2}
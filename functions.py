@@ -1,9 +1,25 @@
 
 import bpy
+import numpy as np
 
+from .constants import GRID_AXES
 from .widget_functions import create_cube_widget, create_sphere_widget, create_circle_widget, create_rectangle_widget
 
 
+def set_mode(obj, mode):
+    # Skip switches to the mode the object is already in, every exit from armature edit mode rebuilds all bones
+    view_layer = bpy.context.view_layer
+    active_object = view_layer.objects.active
+
+    if active_object != obj:
+        if active_object and active_object.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        view_layer.objects.active = obj
+
+    if obj.mode != mode:
+        bpy.ops.object.mode_set(mode=mode)
+
+
 def find_layer_collection(coll_name, layer_coll_root=None):
     if layer_coll_root is None:
         layer_coll_root = bpy.context.view_layer.layer_collection
@@ -89,3 +105,24 @@ def find_objects_that_reference_lattice(lattice_name):
         print(f"Lattice object named '{lattice_name}' not found.")
 
     return meshes_with_lattice_list
+
+
+def get_world_point_grid(lattice):
+    # Transform every lattice point to world space once, as a (w, v, u, 3) array
+    lattice_data = lattice.data
+    coordinates = np.empty(len(lattice_data.points) * 3, dtype=np.float32)
+    lattice_data.points.foreach_get("co", coordinates)
+
+    matrix_world = np.array(lattice.matrix_world, dtype=np.float64)
+    world_points = coordinates.reshape(-1, 3) @ matrix_world[:3, :3].T + matrix_world[:3, 3]
+    return world_points.reshape(lattice_data.points_w, lattice_data.points_v, lattice_data.points_u, 3)
+
+
+def get_group_centers(point_grid, group_axes):
+    # Average over the axes that aren't grouped, the result is indexed in group_axes order
+    grouped_grid_axes = [GRID_AXES[axis] for axis in group_axes]
+    reduced_grid_axes = tuple(grid_axis for grid_axis in range(3) if grid_axis not in grouped_grid_axes)
+    centers = point_grid.mean(axis=reduced_grid_axes) if reduced_grid_axes else point_grid
+
+    remaining_grid_axes = sorted(grouped_grid_axes)
+    return centers.transpose([remaining_grid_axes.index(grid_axis) for grid_axis in grouped_grid_axes] + [len(grouped_grid_axes)])
@@ -0,0 +1,11 @@
+from .constants import RIG_PROPERTY
+
+
+def get_rig_ids(armature):
+    if RIG_PROPERTY not in armature:
+        return []
+    return list(armature[RIG_PROPERTY].keys())
+
+
+def get_rig_metadata(armature, rig_id):
+    return armature[RIG_PROPERTY][rig_id].to_dict()
@@ -0,0 +1,454 @@
+import math
+import time
+import uuid
+from dataclasses import dataclass, field
+
+import bpy
+import mathutils
+import numpy as np
+
+from .constants import GRID_AXES, RIG_PROPERTY, Widget
+from .functions import find_objects_that_reference_lattice, get_group_centers, get_world_point_grid, set_mode, setup_bone_collections, setup_widgets
+from .metadata_functions import get_rig_ids, get_rig_metadata
+from .selection_functions import build_control_index, discard_control_index
+from .armature_functions import align_bone_roll, assign_bone_shape_to_list, assign_bones_to_collection, assign_transform_constraint, assign_copy_scale_constraint, create_bone, duplicate_bone, get_bone_tail
+
+
+# Rotation turning the square widget from the bone's XY plane into the plane of two lattice axes, and the
+# lattice axes the widget's X and Y then run along. U, V and W run along the bone's X, Y and Z.
+SQUARE_WIDGET_PLANES = {
+    frozenset("UV"): (mathutils.Euler((0, 0, 0)), ("U", "V")),
+    frozenset("VW"): (mathutils.Euler((0, math.pi / 2, 0)), ("W", "V")),
+    frozenset("UW"): (mathutils.Euler((math.pi / 2, 0, 0)), ("U", "W")),
+}
+
+
+@dataclass
+class RigResult:
+    """Handles to everything build_lattice_rig created, bones are referenced by name."""
+    rig_id: str
+    armature: bpy.types.Object
+    lattice: bpy.types.Object
+    root_bone: str
+    master_bones: list = field(default_factory=list)
+    # Master bone names per grouping level, outermost level first
+    master_levels: list = field(default_factory=list)
+    # Innermost master bone name -> names of the bones in its group, in lattice point order
+    control_bones_by_master: dict = field(default_factory=dict)
+    def_bones_by_master: dict = field(default_factory=dict)
+    # Vertex group name -> index on the lattice
+    vertex_group_indices: dict = field(default_factory=dict)
+    modifier_name: str = ""
+    # Build phase -> duration in seconds
+    timings: dict = field(default_factory=dict)
+
+    @property
+    def control_bones(self):
+        return [bone_name for bone_names in self.control_bones_by_master.values() for bone_name in bone_names]
+
+    @property
+    def def_bones(self):
+        return [bone_name for bone_names in self.def_bones_by_master.values() for bone_name in bone_names]
+
+
+def new_rig_id():
+    return uuid.uuid4().hex
+
+
+def flatten_matrix(matrix):
+    return [value for row in matrix for value in row]
+
+
+def unflatten_matrix(values):
+    values = list(values)
+    return mathutils.Matrix([values[row * 4:row * 4 + 4] for row in range(4)])
+
+
+def get_parenting(obj):
+    # Snapshot of what parenting an object to the rig changes, used to restore it on removal
+    parenting = {
+        "object": obj,
+        "matrix_parent_inverse": flatten_matrix(obj.matrix_parent_inverse),
+        "matrix_basis": flatten_matrix(obj.matrix_basis),
+    }
+    # ID properties can't hold None, a missing key means the object had no parent
+    if obj.parent:
+        parenting["parent"] = obj.parent
+    return parenting
+
+
+def tag_rig(armature, lattice, rig_id, point_counts, root_bone, master_bones, control_bones, def_bones,
+            collection_names, vertex_group_names, modifier_name, parenting):
+    # Objects are stored as ID pointers so the metadata survives renaming
+    if RIG_PROPERTY not in armature:
+        armature[RIG_PROPERTY] = {}
+    armature[RIG_PROPERTY][rig_id] = {
+        "lattice": lattice,
+        # Lattice resolution at build time, the control bones are laid out on this grid
+        "points": list(point_counts),
+        "root_bone": root_bone,
+        "master_bones": list(master_bones),
+        "control_bones": list(control_bones),
+        "def_bones": list(def_bones),
+        "collections": list(collection_names),
+    }
+
+    lattice[RIG_PROPERTY] = {
+        "rig_id": rig_id,
+        "armature": armature,
+        "vertex_groups": list(vertex_group_names),
+        "modifier": modifier_name,
+        "parenting": list(parenting),
+    }
+
+
+def get_lattice_rig(lattice):
+    # (armature, rig_id) of the rig driving lattice, None if untagged or the armature no longer has the rig
+    if RIG_PROPERTY not in lattice:
+        return None
+    lattice_metadata = lattice[RIG_PROPERTY]
+    armature = lattice_metadata.get("armature")
+    if armature and lattice_metadata["rig_id"] in get_rig_ids(armature):
+        return armature, lattice_metadata["rig_id"]
+    return None
+
+
+def find_rigs(objects):
+    # Collect (armature, rig_id) pairs for tagged lattices and armatures
+    rigs = []
+    for obj in objects:
+        if obj.type == 'LATTICE':
+            if lattice_rig := get_lattice_rig(obj):
+                rigs.append(lattice_rig)
+        elif obj.type == 'ARMATURE':
+            rigs.extend((obj, rig_id) for rig_id in get_rig_ids(obj))
+
+    unique_rigs = []
+    for rig in rigs:
+        if rig not in unique_rigs:
+            unique_rigs.append(rig)
+    return unique_rigs
+
+
+def remove_bones(armature, bone_names):
+    # All bones are removed in a single edit session instead of one mode switch per bone
+    set_mode(armature, 'EDIT')
+    edit_bones = armature.data.edit_bones
+    for bone_name in bone_names:
+        if edit_bone := edit_bones.get(bone_name):
+            edit_bones.remove(edit_bone)
+    set_mode(armature, 'OBJECT')
+
+
+def remove_vertex_groups(obj, vertex_group_names):
+    vertex_group_names = set(vertex_group_names)
+    vertex_groups = obj.vertex_groups
+
+    # Clearing drops every group in one pass, only possible when the rig owns all of them
+    if all(vertex_group.name in vertex_group_names for vertex_group in vertex_groups):
+        vertex_groups.clear()
+        return
+
+    # Removing from the highest index down keeps the reindexing of the remaining groups to a minimum
+    for vertex_group in sorted(vertex_groups, key=lambda group: group.index, reverse=True):
+        if vertex_group.name in vertex_group_names:
+            vertex_groups.remove(vertex_group)
+
+
+def restore_parenting(armature, parenting):
+    for entry in parenting:
+        obj = entry.get("object")
+        # Leave objects alone that have been reparented since the rig was built
+        if not obj or obj.parent != armature:
+            continue
+        obj.parent = entry.get("parent")
+        obj.matrix_parent_inverse = unflatten_matrix(entry["matrix_parent_inverse"])
+        obj.matrix_basis = unflatten_matrix(entry["matrix_basis"])
+
+
+def remove_rig(armature, rig_id):
+    rig_metadata = get_rig_metadata(armature, rig_id)
+    lattice = rig_metadata.get("lattice")
+
+    bone_names = rig_metadata["def_bones"] + rig_metadata["control_bones"] + rig_metadata["master_bones"] + [rig_metadata["root_bone"],]
+    remove_bones(armature, bone_names)
+
+    for collection_name in rig_metadata["collections"]:
+        bone_collection = armature.data.collections.get(collection_name)
+        if bone_collection and not bone_collection.bones:
+            armature.data.collections.remove(bone_collection)
+
+    if lattice and RIG_PROPERTY in lattice and lattice[RIG_PROPERTY]["rig_id"] == rig_id:
+        lattice_metadata = lattice[RIG_PROPERTY].to_dict()
+        remove_vertex_groups(lattice, lattice_metadata["vertex_groups"])
+
+        modifier = lattice.modifiers.get(lattice_metadata["modifier"])
+        if modifier and modifier.type == 'ARMATURE' and modifier.object == armature:
+            lattice.modifiers.remove(modifier)
+
+        restore_parenting(armature, lattice_metadata["parenting"])
+        del lattice[RIG_PROPERTY]
+
+    discard_control_index(armature, rig_id)
+    del armature[RIG_PROPERTY][rig_id]
+    if not armature[RIG_PROPERTY]:
+        del armature[RIG_PROPERTY]
+
+    print(f"Rig '{rig_id}' has been removed from armature '{armature.name}'.")
+
+
+def get_master_widget_transform(lattice, level_axes):
+    # A group spans the whole lattice along the axes it isn't grouped by, along a grouped axis the widget
+    # only gets half the slice spacing so masters of neighbouring groups and levels stay apart
+    free_axes = [axis for axis in "UVW" if axis not in level_axes]
+    plane_axes = (free_axes + list(reversed(level_axes)))[:2]
+    rotation, widget_axes = SQUARE_WIDGET_PLANES[frozenset(plane_axes)]
+
+    point_counts = (lattice.data.points_u, lattice.data.points_v, lattice.data.points_w)
+    extents = []
+    for axis in widget_axes:
+        axis_index = "UVW".index(axis)
+        extent = abs(lattice.scale[axis_index])
+        if axis not in free_axes:
+            extent = extent / max(point_counts[axis_index] - 1, 1) / 2
+        extents.append(extent)
+
+    return rotation, mathutils.Vector((extents[0], extents[1], 1))
+
+
+def check_rig_options(lattice, group_axes):
+    # Raises ValueError before anything is built, so callers can report it without an undo step to worry about
+    if not group_axes or len(set(group_axes)) != len(group_axes) or not set(group_axes) <= set(GRID_AXES):
+        raise ValueError(f"group_axes must be distinct lattice axes out of 'U', 'V' and 'W', got {tuple(group_axes)}")
+
+    # A lattice holds the metadata and original parenting of a single rig, a second rig would overwrite both
+    if lattice_rig := get_lattice_rig(lattice):
+        raise ValueError(f"Lattice '{lattice.name}' is already rigged to armature '{lattice_rig[0].name}', unrig it first")
+
+
+def build_lattice_rig(lattice, armature, align_with_lattice=True, root_to_bottom=False, bone_name=None,
+                      def_prefix="DEF", def_collection_name="Deform Bones", lattice_collection_name="Lattice",
+                      group_axes=("W",)):
+    """Rig lattice to armature without relying on selection, active object or mode.
+
+    group_axes lists the lattice axes the master bones group the points by, each further axis adds a
+    nested level of masters, ("W", "V") creates a master per layer with a master per row inside it.
+    Objects are deselected during the build, the selection, the active object and its mode are restored
+    afterwards, also when the build fails. The armature and lattice end in object mode.
+    """
+    group_axes = tuple(group_axes)
+    check_rig_options(lattice, group_axes)
+
+    bone_length = 0.3
+    bone_name = bone_name or lattice.name
+    start_time = time.perf_counter()
+    timings = {}
+
+    view_layer = bpy.context.view_layer
+    previous_active = view_layer.objects.active
+    previous_mode = previous_active.mode if previous_active else 'OBJECT'
+
+    # Everything created is recorded as it goes, so a failed build can be tagged and removed again
+    rig_id = new_rig_id()
+    root_bone_name = ""
+    master_bones = []
+    master_levels = []
+    def_bones = []
+    control_bones = []
+    vertex_group_indices = {}
+    modifier = None
+
+    # Snapshot the parenting of the lattice and its users before anything changes
+    referenced_mesh_objects = [bpy.data.objects.get(mesh_object_name) for mesh_object_name in find_objects_that_reference_lattice(lattice.name)]
+    parenting = [get_parenting(obj) for obj in [lattice,] + referenced_mesh_objects]
+
+    def tag_created():
+        tag_rig(armature, lattice, rig_id,
+                point_counts=(lattice.data.points_u, lattice.data.points_v, lattice.data.points_w),
+                root_bone=root_bone_name,
+                master_bones=master_bones,
+                control_bones=control_bones,
+                def_bones=def_bones,
+                collection_names=[def_collection_name, lattice_collection_name,],
+                vertex_group_names=list(vertex_group_indices),
+                modifier_name=modifier.name if modifier else "",
+                parenting=parenting)
+
+    # Other selected armatures would be pulled into multi-object edit mode along with armature
+    selected_objects = [obj for obj in view_layer.objects if obj.select_get()]
+    for obj in selected_objects:
+        obj.select_set(False)
+
+    try:
+        lattice_matrix_world = lattice.matrix_world
+        points_u, points_v = lattice.data.points_u, lattice.data.points_v
+        point_strides = {"U": 1, "V": points_u, "W": points_u * points_v}
+
+        # Every point is transformed once, group centers and bone tails are array operations on the result
+        point_grid = get_world_point_grid(lattice)
+        if align_with_lattice:
+            tail_direction = np.array(lattice_matrix_world.to_3x3() @ mathutils.Vector((0, 1, 0)))
+        else:
+            tail_direction = np.array((0, 1, 0))
+
+        # All bones are created in this single edit session
+        set_mode(armature, 'EDIT')
+
+        # Create root bone at lattice origin
+        lattice_world_location = lattice_matrix_world.translation
+        root_offset = lattice.scale.z / 2
+        bone_head = lattice_world_location
+        if root_to_bottom:
+            bone_head = lattice_world_location + (lattice_matrix_world.to_3x3() @ mathutils.Vector((0, 0, -1))).normalized() * root_offset
+        local_tail_offset = mathutils.Vector((0, bone_length * 3, 0))
+
+        bone_tail = get_bone_tail(align_with_lattice, lattice_matrix_world, bone_head, local_tail_offset)
+
+        root_bone = create_bone(armature, f"{def_prefix}-{bone_name}_root", bone_head, bone_tail)
+        align_bone_roll(align_with_lattice, lattice_matrix_world, root_bone)
+        root_bone.use_deform = False
+        root_bone_name = root_bone.name
+
+        # Create a master bone per group on every level, parented to the enclosing group's master
+        parent_masters = {(): root_bone}
+        for level in range(len(group_axes)):
+            level_axes = group_axes[:level + 1]
+            centers = get_group_centers(point_grid, level_axes)
+            tails = centers + tail_direction * bone_length * 2
+
+            level_masters = {}
+            level_master_bones = []
+            master_levels.append(level_master_bones)
+            for group_key in np.ndindex(centers.shape[:-1]):
+                # Groups are named after their first lattice point
+                group_index = sum(axis_index * point_strides[axis] for axis_index, axis in zip(group_key, level_axes))
+                master_bone_name = f"parent_{bone_name}_{group_index}" if level == 0 else f"parent_{bone_name}_{group_index}_{level}"
+
+                group_parent_bone = create_bone(armature, master_bone_name, centers[group_key].tolist(), tails[group_key].tolist())
+                align_bone_roll(align_with_lattice, lattice_matrix_world, group_parent_bone)
+                group_parent_bone.use_deform = False
+                group_parent_bone.parent = parent_masters[group_key[:-1]]
+                level_masters[group_key] = group_parent_bone
+                level_master_bones.append(group_parent_bone.name)
+                master_bones.append(group_parent_bone.name)
+
+            parent_masters = level_masters
+
+        # Create bones at each vertex of the lattice, in point order so bone i deforms vertex i
+        control_bones_by_master = {master_bone.name: [] for master_bone in parent_masters.values()}
+        def_bones_by_master = {master_bone.name: [] for master_bone in parent_masters.values()}
+
+        point_indices = np.indices(point_grid.shape[:-1])
+        point_group_keys = np.stack([point_indices[GRID_AXES[axis]].ravel() for axis in group_axes], axis=1).tolist()
+        heads = point_grid.reshape(-1, 3)
+        tails = heads + tail_direction * bone_length
+        for global_index, (bone_head, bone_tail, group_key) in enumerate(zip(heads.tolist(), tails.tolist(), point_group_keys)):
+            group_parent_bone = parent_masters[tuple(group_key)]
+
+            # Create a deform bone in edit mode
+            def_bone_name = f"DEF-{bone_name}_{global_index}"
+            def_bone = create_bone(armature, def_bone_name, bone_head, bone_tail)
+            align_bone_roll(align_with_lattice, lattice_matrix_world, def_bone)
+            def_bone.parent = root_bone
+            def_bones.append(def_bone.name)
+            def_bones_by_master[group_parent_bone.name].append(def_bone.name)
+
+            # create control bone for deformation bone and setup constraints
+            control_bone_name = f"{bone_name}_{global_index}"
+            control_bone = duplicate_bone(armature, def_bone.name, control_bone_name, keep_parent=False)
+            control_bone.parent = group_parent_bone
+            control_bones.append(control_bone.name)
+            control_bones_by_master[group_parent_bone.name].append(control_bone.name)
+
+        timings["bones"] = time.perf_counter() - start_time
+        phase_start = time.perf_counter()
+
+        # Assign constraints    
+        set_mode(armature, 'POSE')
+        for index, def_bone in enumerate(def_bones):
+            assign_transform_constraint(armature, def_bone, control_bones[index])
+            assign_copy_scale_constraint(armature, control_bones[index], root_bone_name)
+    
+        # Create widget collection and widget shapes
+        setup_widgets()
+
+        # assign bone shapes
+        align_with_object_name = lattice.name if not align_with_lattice else None
+        assign_bone_shape_to_list(armature, Widget.SPHERE, control_bones)
+        for level, level_master_bones in enumerate(master_levels):
+            # Each level's square lies in the plane its groups span, sized to the group
+            square_custom_rotation, square_custom_scale = get_master_widget_transform(lattice, group_axes[:level + 1])
+            assign_bone_shape_to_list(armature, Widget.SQUARE, level_master_bones, 
+                                      custom_scale=square_custom_scale,
+                                      custom_rotation=square_custom_rotation,
+                                      align_with_object_name=align_with_object_name)
+        assign_bone_shape_to_list(armature, Widget.CUBE, [root_bone_name,])
+
+        # assign bones to collections
+        setup_bone_collections(armature, [def_collection_name, lattice_collection_name,], collections_to_hide=[def_collection_name,])
+        assign_bones_to_collection(armature, def_bones, def_collection_name)
+        assign_bones_to_collection(armature, control_bones + master_bones + [root_bone_name,], lattice_collection_name)
+
+        armature.update_tag()
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        depsgraph.update()
+
+        set_mode(armature, 'OBJECT')
+        set_mode(lattice, 'OBJECT')
+
+        timings["pose"] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
+
+        # Add vertex groups and assign weights for each bone
+        for vertex_index, def_bone_name in enumerate(def_bones):
+            vertex_group = lattice.vertex_groups.new(name=def_bone_name)
+            vertex_group_indices[vertex_group.name] = vertex_group.index
+            vertex_group.add([vertex_index], 1.0, 'REPLACE')
+
+        # Add armature modifier to the lattice
+        modifier = lattice.modifiers.new(name="Armature", type='ARMATURE')
+        modifier.object = armature
+
+        # Parent lattice and meshes referencing the lattice to the armature
+        lattice.parent = armature
+        for mesh_object in referenced_mesh_objects:
+            mesh_object.parent = armature
+
+        # Tag the armature and lattice so the rig can be removed again
+        tag_created()
+
+        timings["lattice"] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
+
+        # Spatial index over the control bones for fast region selection
+        build_control_index(armature, rig_id)
+
+        timings["index"] = time.perf_counter() - phase_start
+    except Exception:
+        # Remove the partial rig, if that fails as well the tag lets Unrig Lattice finish the job
+        tag_created()
+        remove_rig(armature, rig_id)
+        raise
+    finally:
+        # Also on failure, so callers building in a loop aren't left in edit or pose mode
+        set_mode(armature, 'OBJECT')
+        for obj in selected_objects:
+            obj.select_set(True)
+        if previous_active:
+            set_mode(previous_active, previous_mode)
+
+    timings["total"] = time.perf_counter() - start_time
+
+    return RigResult(
+        rig_id=rig_id,
+        armature=armature,
+        lattice=lattice,
+        root_bone=root_bone_name,
+        master_bones=master_bones,
+        master_levels=master_levels,
+        control_bones_by_master=control_bones_by_master,
+        def_bones_by_master=def_bones_by_master,
+        vertex_group_indices=vertex_group_indices,
+        modifier_name=modifier.name,
+        timings=timings,
+    )
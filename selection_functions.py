@@ -0,0 +1,152 @@
+from dataclasses import dataclass
+
+import bpy
+from bpy.app.handlers import persistent
+from mathutils.kdtree import KDTree
+
+from .constants import RIG_PROPERTY
+from .metadata_functions import get_rig_ids
+
+
+@dataclass
+class ControlIndex:
+    """KD-tree over the control bone heads of one rig, KD-tree indices are lattice point indices."""
+    kd_tree: KDTree
+    # Control bone names in lattice point order
+    bone_names: list
+    points_u: int
+    points_v: int
+    points_w: int
+
+
+# KD-trees can't be stored in blend data, so they live here keyed by (armature session uid, rig id).
+# The session uid survives renaming and undo, unlike the name or the pointer.
+_control_indices = {}
+
+
+def prune_control_indices(armature=None):
+    # Drop the trees of rigs that no longer exist, such as builds undone by the redo panel.
+    # Without an armature every cached tree is checked against the armatures in the file.
+    if armature:
+        live_keys = {(armature.session_uid, rig_id) for rig_id in get_rig_ids(armature)}
+        stale_keys = [key for key in _control_indices if key[0] == armature.session_uid and key not in live_keys]
+    else:
+        live_keys = {(obj.session_uid, rig_id) for obj in bpy.data.objects if obj.type == 'ARMATURE' for rig_id in get_rig_ids(obj)}
+        stale_keys = [key for key in _control_indices if key not in live_keys]
+
+    for key in stale_keys:
+        del _control_indices[key]
+
+
+def clear_control_indices():
+    _control_indices.clear()
+
+
+@persistent
+def prune_control_indices_handler(*_args):
+    prune_control_indices()
+
+
+@persistent
+def clear_control_indices_handler(*_args):
+    clear_control_indices()
+
+
+def build_control_index(armature, rig_id):
+    rig_metadata = armature[RIG_PROPERTY][rig_id]
+    bone_names = list(rig_metadata["control_bones"])
+
+    # Pose heads so the index follows the controls after they have been moved, missing bones stay out of the tree
+    pose_bones = armature.pose.bones
+    matrix_world = armature.matrix_world
+    kd_tree = KDTree(len(bone_names))
+    for point_index, bone_name in enumerate(bone_names):
+        if pose_bone := pose_bones.get(bone_name):
+            kd_tree.insert(matrix_world @ pose_bone.head, point_index)
+    kd_tree.balance()
+
+    # The resolution the rig was built with, the lattice may have been resized since
+    points_u, points_v, points_w = rig_metadata["points"]
+
+    control_index = ControlIndex(kd_tree, bone_names, points_u, points_v, points_w)
+    prune_control_indices(armature)
+    _control_indices[(armature.session_uid, rig_id)] = control_index
+    return control_index
+
+
+def get_control_index(armature, rig_id):
+    if control_index := _control_indices.get((armature.session_uid, rig_id)):
+        return control_index
+    return build_control_index(armature, rig_id)
+
+
+def get_control_indices(armature):
+    prune_control_indices(armature)
+    return [get_control_index(armature, rig_id) for rig_id in get_rig_ids(armature)]
+
+
+def refresh_control_indices(armature):
+    return [build_control_index(armature, rig_id) for rig_id in get_rig_ids(armature)]
+
+
+def discard_control_index(armature, rig_id):
+    _control_indices.pop((armature.session_uid, rig_id), None)
+
+
+def find_controls_in_radius(control_index, center, radius):
+    return [control_index.bone_names[point_index] for _co, point_index, _distance in control_index.kd_tree.find_range(center, radius)]
+
+
+def find_controls_in_range(control_index, u_range, v_range, w_range):
+    # Lattice points are ordered u first, then v, then w, so the names are looked up directly
+    points_u, points_v = control_index.points_u, control_index.points_v
+    if points_u * points_v * control_index.points_w != len(control_index.bone_names):
+        raise ValueError(f"Rig has {len(control_index.bone_names)} controls, which don't fill a {points_u}x{points_v}x{control_index.points_w} lattice grid")
+
+    ranges = []
+    for (start, end), point_count in zip((u_range, v_range, w_range), (points_u, points_v, control_index.points_w)):
+        ranges.append(range(max(start, 0), min(end, point_count - 1) + 1))
+    u_indices, v_indices, w_indices = ranges
+
+    return [control_index.bone_names[u + v * points_u + w * points_u * points_v]
+            for w in w_indices for v in v_indices for u in u_indices]
+
+
+def find_nearest_control(control_index, co):
+    _co, point_index, distance = control_index.kd_tree.find(co)
+    if point_index is None:
+        return None, None
+    return control_index.bone_names[point_index], distance
+
+
+def get_selected_vertex_coordinates(obj, depsgraph):
+    # Use the deformed vertex positions when the evaluated mesh still matches the original topology
+    vertices = obj.data.vertices
+    evaluated_vertices = obj.evaluated_get(depsgraph).data.vertices
+    if len(evaluated_vertices) != len(vertices):
+        evaluated_vertices = vertices
+
+    matrix_world = obj.matrix_world
+    selected = [False] * len(vertices)
+    vertices.foreach_get("select", selected)
+    return [matrix_world @ evaluated_vertices[index].co for index, is_selected in enumerate(selected) if is_selected]
+
+
+def select_bones(armature, bone_names, extend=False):
+    # Replacing the selection costs one pass over all pose bones in C, bones selected by hand can be anywhere.
+    # Selecting goes through the hashed name lookup, so in Python only the matched bones are touched.
+    if not extend:
+        bpy.ops.pose.select_all(action='DESELECT')
+
+    bones = armature.data.bones
+    selected_count = 0
+    for bone_name in bone_names:
+        if bone := bones.get(bone_name):
+            bone.select = True
+            bone.select_head = True
+            bone.select_tail = True
+            selected_count += 1
+
+    if bone_names and (bone := bones.get(bone_names[-1])):
+        bones.active = bone
+    return selected_count